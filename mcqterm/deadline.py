@@ -0,0 +1,203 @@
+"""
+Provide a central deadline scheduler shared by all the sessions of an event loop.
+
+Expirations are driven by a single heap and a single timer handle, while
+countdown refreshes are driven by a single timer wheel whose slots are
+processed one after the other, spreading the redraws of the sessions over
+each second instead of invalidating all the applications at the same instant.
+"""
+
+import time
+import heapq
+import asyncio
+import weakref
+import itertools
+from datetime import datetime
+
+import structlog
+
+LOGGER = structlog.get_logger()
+
+WHEEL_SLOTS = 10
+WHEEL_PERIOD = 1.0
+
+_SCHEDULERS = weakref.WeakKeyDictionary()
+
+
+def format_remaining(remaining):
+    remaining = max(0, int(remaining + 0.999))
+    minutes, seconds = divmod(remaining, 60)
+    # Only show the seconds during the last minutes, in order to limit redraws
+    if minutes >= 10:
+        return f"{minutes} min left"
+    return f"{minutes:02d}:{seconds:02d} left"
+
+
+def parse_deadline(value):
+    return datetime.fromisoformat(value).timestamp()
+
+
+def get_deadline(result_dict, time_limit=None, exam_deadline=None):
+    deadlines = []
+    if time_limit is not None:
+        started = result_dict.setdefault("started", time.time())
+        deadlines.append(started + time_limit)
+    if exam_deadline is not None:
+        deadlines.append(exam_deadline)
+    return min(deadlines, default=None)
+
+
+class DeadlineEntry:
+    def __init__(self, scheduler, deadline, on_expire, on_change, slot):
+        self.scheduler = scheduler
+        self.deadline = deadline
+        self.on_expire = on_expire
+        self.on_change = on_change
+        self.slot = slot
+        self.expired = False
+        self.cancelled = False
+        self.text = format_remaining(self.remaining)
+
+    def __lt__(self, other):
+        return self.deadline < other.deadline
+
+    @property
+    def remaining(self):
+        return self.deadline - time.time()
+
+    def refresh(self):
+        text = format_remaining(self.remaining)
+        if text == self.text:
+            return
+        self.text = text
+        if self.on_change is not None:
+            self.on_change()
+
+    def expire(self):
+        self.expired = True
+        self.text = format_remaining(0)
+        self.on_expire()
+
+    def cancel(self):
+        self.scheduler.unregister(self)
+
+
+class DeadlineScheduler:
+    def __init__(self, loop):
+        self.loop = loop
+        self._heap = []
+        self._expire_handle = None
+        self._wheel = [set() for _ in range(WHEEL_SLOTS)]
+        self._wheel_handle = None
+        self._wheel_cursor = 0
+        self._slot_counter = itertools.count()
+        self._size = 0
+
+    def register(self, deadline, on_expire, on_change=None):
+        slot = next(self._slot_counter) % WHEEL_SLOTS
+        entry = DeadlineEntry(self, deadline, on_expire, on_change, slot)
+        heapq.heappush(self._heap, entry)
+        self._wheel[slot].add(entry)
+        self._size += 1
+        self._schedule_expire()
+        self._schedule_wheel()
+        return entry
+
+    def unregister(self, entry):
+        if entry.cancelled:
+            return
+        entry.cancelled = True
+        self._wheel[entry.slot].discard(entry)
+        self._size -= 1
+        # Cancelled entries are lazily removed from the heap
+        if self._heap and self._heap[0] is entry:
+            self._schedule_expire()
+        if not self._size and self._wheel_handle is not None:
+            self._wheel_handle.cancel()
+            self._wheel_handle = None
+
+    # Expiration heap
+
+    def _schedule_expire(self):
+        while self._heap and self._heap[0].cancelled:
+            heapq.heappop(self._heap)
+        if self._expire_handle is not None:
+            self._expire_handle.cancel()
+            self._expire_handle = None
+        if not self._heap:
+            return
+        when = self.loop.time() + max(0, self._heap[0].remaining)
+        self._expire_handle = self.loop.call_at(when, self._expire)
+
+    def _expire(self):
+        self._expire_handle = None
+        now = time.time()
+        while self._heap and self._heap[0].deadline <= now:
+            entry = heapq.heappop(self._heap)
+            if entry.cancelled:
+                continue
+            self.unregister(entry)
+            # A failing session must not stop the scheduler for the others
+            try:
+                entry.expire()
+            except Exception:
+                LOGGER.exception("Failed to expire a deadline")
+        self._schedule_expire()
+
+    # Countdown wheel
+
+    def _schedule_wheel(self):
+        if self._wheel_handle is not None or not self._size:
+            return
+        delay = WHEEL_PERIOD / WHEEL_SLOTS
+        self._wheel_handle = self.loop.call_later(delay, self._tick)
+
+    def _tick(self):
+        self._wheel_handle = None
+        for entry in list(self._wheel[self._wheel_cursor]):
+            try:
+                entry.refresh()
+            except Exception:
+                LOGGER.exception("Failed to refresh a countdown")
+        self._wheel_cursor = (self._wheel_cursor + 1) % WHEEL_SLOTS
+        self._schedule_wheel()
+
+
+class Countdown:
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.entry = None
+
+    @property
+    def text(self):
+        if self.entry is None:
+            return format_remaining(self.deadline - time.time())
+        return self.entry.text
+
+    @property
+    def expired(self):
+        return self.entry is not None and self.entry.expired
+
+    def start(self, on_expire, on_change=None):
+        if self.entry is None:
+            scheduler = get_deadline_scheduler()
+            self.entry = scheduler.register(self.deadline, on_expire, on_change)
+            return
+        # Swap the callbacks, e.g when a new prompt application is running
+        self.entry.on_expire = on_expire
+        self.entry.on_change = on_change
+        if self.entry.expired:
+            on_expire()
+
+    def stop(self):
+        if self.entry is not None:
+            self.entry.cancel()
+
+
+def get_deadline_scheduler(loop=None):
+    if loop is None:
+        loop = asyncio.get_running_loop()
+    try:
+        return _SCHEDULERS[loop]
+    except KeyError:
+        return _SCHEDULERS.setdefault(loop, DeadlineScheduler(loop))
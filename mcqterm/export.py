@@ -0,0 +1,197 @@
+"""
+Export all the results into a single CSV or Parquet file.
+
+The results are streamed through a generator pipeline: result files are
+parsed in a thread pool with a bounded number of files in flight, or other
+stores are scanned one page at a time. They are then normalized against the
+MCQ and written in batches, so the memory usage does not depend on the
+number of candidates.
+"""
+
+import os
+import sys
+import csv
+import json
+import asyncio
+import argparse
+import itertools
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .mcqcommon import parse_mcq, normalize_result
+from .store import RESULTS, open_store, read_secret
+
+MAX_WORKERS = 8
+BATCH_SIZE = 4096
+FORMATS = ("csv", "parquet")
+
+
+def iter_result_paths(result_dir):
+    # Only the file names are sorted in memory, for a reproducible output
+    with os.scandir(result_dir) as entries:
+        names = sorted(
+            entry.name
+            for entry in entries
+            if entry.name.endswith(".json") and entry.is_file()
+        )
+    for name in names:
+        yield Path(result_dir) / name
+
+
+def read_result_file(path):
+    # Unlike read_json, keep the errors, so they can be reported
+    try:
+        return json.loads(path.read_text())
+    except (OSError, ValueError) as exc:
+        return exc
+
+
+def iter_results(paths, max_workers=MAX_WORKERS):
+    # Keep a bounded window of files in flight, preserving the order
+    with ThreadPoolExecutor(max_workers) as executor:
+        pending = deque()
+        for path in paths:
+            pending.append((path, executor.submit(read_result_file, path)))
+            if len(pending) >= 2 * max_workers:
+                path, future = pending.popleft()
+                yield path.stem, future.result()
+        while pending:
+            path, future = pending.popleft()
+            yield path.stem, future.result()
+
+
+def iter_store_results(store):
+    # Pull the results from the store one item at a time, on a private loop
+    loop = asyncio.new_event_loop()
+    items = store.iter_items(RESULTS)
+    try:
+        while True:
+            try:
+                username, value = loop.run_until_complete(items.__anext__())
+            except StopAsyncIteration:
+                return
+            yield username, value
+    finally:
+        loop.run_until_complete(items.aclose())
+        loop.run_until_complete(store.close())
+        loop.close()
+
+
+def iter_valid_results(results):
+    # Invalid results are left out and reported, rather than exported as
+    # blank rows that look like candidates who did not answer
+    for username, value in results:
+        if isinstance(value, Exception):
+            print(f"Skipping the result of {username!r}: {value}", file=sys.stderr)
+        elif not isinstance(value, dict):
+            print(
+                f"Skipping the result of {username!r}: not a JSON object",
+                file=sys.stderr,
+            )
+        else:
+            yield username, normalize_result(value)
+
+
+def get_columns(mcq):
+    questions = [f"q{i}" for i in range(1, len(mcq.answers) + 1)]
+    return ["username", "name", *questions, "comment", "started"]
+
+
+def iter_rows(mcq, results):
+    allowed = [set(answer_dict) for _, answer_dict in mcq.answers]
+    for username, result in results:
+        answers = result["answers"]
+        if not isinstance(answers, dict):
+            answers = {}
+        row = [username, str(result["name"])]
+        for i, letters in enumerate(allowed, 1):
+            answer = set(str(answers.get(f"{i}", "")).upper())
+            row.append("".join(sorted(answer & letters)))
+        started = result.get("started")
+        row.append(str(result["comment"]))
+        row.append(float(started) if isinstance(started, (int, float)) else None)
+        yield row
+
+
+def iter_batches(rows, batch_size=BATCH_SIZE):
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def write_csv(file, columns, rows):
+    writer = csv.writer(file)
+    writer.writerow(columns)
+    writer.writerows(rows)
+
+
+def write_parquet(path, columns, rows, batch_size=BATCH_SIZE):
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise SystemExit("The parquet format requires pyarrow to be installed")
+
+    fields = [(column, pyarrow.string()) for column in columns[:-1]]
+    schema = pyarrow.schema([*fields, (columns[-1], pyarrow.float64())])
+    with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+        for batch in iter_batches(rows, batch_size):
+            arrays = [list(column) for column in zip(*batch)]
+            writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+
+
+def export_results(
+    mcq_filename, result_dir, output=None, output_format="csv", store=None
+):
+    mcq = parse_mcq(mcq_filename)
+    columns = get_columns(mcq)
+    # The result files are read directly, other stores are scanned
+    if store is None:
+        results = iter_results(iter_result_paths(result_dir))
+    else:
+        results = iter_store_results(store)
+    rows = iter_rows(mcq, iter_valid_results(results))
+    if output_format == "parquet":
+        assert output is not None
+        return write_parquet(output, columns, rows)
+    if output is None:
+        return write_csv(sys.stdout, columns, rows)
+    with open(output, "w", newline="") as f:
+        return write_csv(f, columns, rows)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog="mcqterm export")
+    parser.add_argument("--result-dir", "-r", type=Path, default=Path("results"))
+    parser.add_argument("--output", "-o", type=Path, default=None)
+    parser.add_argument("--format", "-f", choices=FORMATS, default=None)
+    parser.add_argument("--store", type=str, default="files")
+    parser.add_argument("--store-secret-file", type=Path, default=None)
+    parser.add_argument("mcq_filename", metavar="MCQ_FILE", type=Path)
+    namespace = parser.parse_args(args)
+    output_format = namespace.format
+    if output_format is None and namespace.output is not None:
+        output_format = "parquet" if namespace.output.suffix == ".parquet" else "csv"
+    if output_format == "parquet" and namespace.output is None:
+        parser.error("the parquet format requires an output file")
+    if namespace.store == "files" and not namespace.result_dir.is_dir():
+        parser.error(f"result directory {str(namespace.result_dir)!r} not found")
+    store = None
+    if namespace.store != "files":
+        secret = read_secret(namespace.store_secret_file)
+        store = open_store(namespace.store, secret=secret)
+    export_results(
+        namespace.mcq_filename,
+        namespace.result_dir,
+        namespace.output,
+        output_format or "csv",
+        store,
+    )
+
+
+if __name__ == "__main__":
+    main()
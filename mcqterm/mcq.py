@@ -2,19 +2,32 @@
 An MCQ prompt-toolkit application.
 """
 
+import string
 import asyncio
 import argparse
 from pathlib import Path
-from functools import partial
+from functools import partial, lru_cache
 
 from prompt_toolkit.filters import Condition
 from prompt_toolkit.validation import Validator
 from prompt_toolkit.key_binding import KeyBindings
-from prompt_toolkit import PromptSession, ANSI, HTML
+from prompt_toolkit import PromptSession, HTML
 from prompt_toolkit.application import get_app_session
 from prompt_toolkit.formatted_text import to_formatted_text
 
-from .mcqcommon import parse_mcq, read_json, write_json, md_render
+from .mcqcommon import parse_mcq, MarkdownRenderer
+from .store import FileStore, StoreWriter, RESULTS, read_result
+from .deadline import Countdown, get_deadline, parse_deadline
+
+
+TOOLBAR_RIGHT = to_formatted_text(
+    HTML('Color swap: <style bg="#222222" fg="#ff8888">[control-t]</style>')
+)
+
+LETTER_BITS = {
+    **{letter: 1 << i for i, letter in enumerate(string.ascii_uppercase)},
+    **{letter: 1 << i for i, letter in enumerate(string.ascii_lowercase)},
+}
 
 
 def mcq_validate(answer_set, text):
@@ -22,68 +35,146 @@ def mcq_validate(answer_set, text):
     return len(text_set) == len(text) and text_set <= answer_set
 
 
-def mcq_validator(answer):
+def mcq_mask_validate(mask, text):
+    # Every character is an allowed letter, and appears only once
+    seen = 0
+    for char in text:
+        bit = LETTER_BITS.get(char, 0) & mask
+        if not bit or seen & bit:
+            return False
+        seen |= bit
+    return True
+
+
+@lru_cache(maxsize=None)
+def _mcq_validator(letters):
+    mask = 0
+    for letter in letters:
+        mask |= LETTER_BITS[letter]
     return Validator.from_callable(
-        lambda text: mcq_validate(set(answer), text),
+        lambda text: mcq_mask_validate(mask, text),
         error_message="Invalid input",
     )
 
 
-async def run_mcq_prompts(app_session, mcq_filename, result_dict, dump=None):
+def mcq_validator(answer):
+    # Validators are compiled once and shared by all the sessions
+    return _mcq_validator("".join(sorted(answer)))
+
+
+def concat_formatted_text(get_first, second):
+    # Only concatenate again when the first part changes
+    second = to_formatted_text(second)
+    last_first = last_result = None
+
+    def get_text():
+        nonlocal last_first, last_result
+        first = get_first()
+        if first is not last_first:
+            last_first = first
+            last_result = to_formatted_text(first) + second
+        return last_result
+
+    return get_text
+
+
+def make_bottom_toolbar(app_session, text, countdown=None):
+    left = to_formatted_text(HTML(text))
+    length = sum(len(text) for _, text in left + TOOLBAR_RIGHT)
+    last_key = last_result = None
+
+    # Only build the fragments again when the width or the countdown changes
+    def bottom_toolbar():
+        nonlocal last_key, last_result
+        columns = app_session.output.get_size().columns
+        countdown_text = None if countdown is None else f"⏱ {countdown.text}  "
+        key = columns, countdown_text
+        if key != last_key:
+            right = TOOLBAR_RIGHT
+            if countdown_text is not None:
+                right = to_formatted_text(countdown_text) + right
+            spacing = " " * (columns - length - len(countdown_text or ""))
+            last_key = key
+            last_result = left + to_formatted_text(spacing) + right
+        return last_result
+
+    return bottom_toolbar
+
+
+async def run_mcq_prompts(
+    app_session,
+    mcq_filename,
+    result_dict,
+    dump=None,
+    countdown=None,
+    renderer=None,
+    profiler=None,
+):
+    if renderer is None:
+        renderer = MarkdownRenderer(app_session)
     swapped = False
     bindings = KeyBindings()
     prompt_sesion = PromptSession(key_bindings=bindings)
+    if profiler is not None:
+        profiler.attach(prompt_sesion.app)
 
     @bindings.add("c-t")
     def _(event):
         nonlocal swapped
         swapped = not swapped
 
-    def bottom_toolbar(text=""):
-        left = text
-        right = 'Color swap: <style bg="#222222" fg="#ff8888">[control-t]</style>'
-        formatted_left = to_formatted_text(HTML(left))
-        formatted_right = to_formatted_text(HTML(right))
-        length = sum(len(text) for _, text in formatted_left + formatted_right)
-        columns = app_session.output.get_size().columns
-        spacing = to_formatted_text(" " * (columns - length))
-        return formatted_left + spacing + formatted_right
+    def expire_handler():
+        # Auto-submit the current input
+        if prompt_sesion.app.is_running and not prompt_sesion.app.is_done:
+            prompt_sesion.app.exit(result=prompt_sesion.default_buffer.text)
+
+    def start_countdown():
+        if countdown is not None:
+            countdown.start(expire_handler, prompt_sesion.app.invalidate)
+
+    def expired():
+        return countdown is not None and countdown.expired
+
+    swap_light_and_dark_colors = Condition(lambda: swapped)
 
     # Parse question markdown file
     mcq = parse_mcq(mcq_filename)
 
-    def formatted_header():
-        term = app_session.output.term
-        columns = app_session.output.get_size().columns
-        header = ANSI(md_render(mcq.header, term, columns))
-        return to_formatted_text(header) + to_formatted_text(">>> ")
+    formatted_header = concat_formatted_text(
+        lambda: renderer.render(mcq.header), ">>> "
+    )
 
     name = await prompt_sesion.prompt_async(
         formatted_header,
         default=result_dict["name"],
-        bottom_toolbar=lambda: bottom_toolbar("Please enter your name"),
-        swap_light_and_dark_colors=Condition(lambda: swapped),
+        bottom_toolbar=make_bottom_toolbar(
+            app_session, "Please enter your name", countdown
+        ),
+        swap_light_and_dark_colors=swap_light_and_dark_colors,
+        pre_run=start_countdown,
     )
     result_dict["name"] = name
     if dump is not None:
         dump(result_dict)
+    if expired():
+        return result_dict
 
     # Loop over entries
+    question_toolbar = make_bottom_toolbar(
+        app_session, "Pick zero, one or more answers", countdown
+    )
     for i, (question, (answers, answer_dict)) in enumerate(
         zip(mcq.questions, mcq.answers), 1
     ):
 
         # Format the question
-        def formatted_question():
-            term = app_session.output.term
-            columns = app_session.output.get_size().columns
-            ansi_question = md_render(question + "\n\n" + answers, term, columns)
-            html_prompt = (
-                f'⦗ {i} ⦘ <style fg="#aaaaaa">{"/".join(answer_dict)}?</style> '
-            )
-            return to_formatted_text(ANSI(ansi_question)) + to_formatted_text(
-                HTML(html_prompt)
-            )
+        source = question + "\n\n" + answers
+        html_prompt = (
+            f'⦗ {i} ⦘ <style fg="#aaaaaa">{"/".join(answer_dict)}?</style> '
+        )
+        formatted_question = concat_formatted_text(
+            partial(renderer.render, source), HTML(html_prompt)
+        )
 
         # Prompt for tentative answer
         default = result_dict["answers"].get(f"{i}", "")
@@ -92,30 +183,36 @@ async def run_mcq_prompts(app_session, mcq_filename, result_dict, dump=None):
             default=default,
             validator=mcq_validator(answer_dict),
             validate_while_typing=True,
-            bottom_toolbar=lambda: bottom_toolbar("Pick zero, one or more answers"),
-            swap_light_and_dark_colors=Condition(lambda: swapped),
+            bottom_toolbar=question_toolbar,
+            swap_light_and_dark_colors=swap_light_and_dark_colors,
+            pre_run=start_countdown,
         )
 
+        # Discard an invalid tentative answer submitted on expiration
+        if expired() and not mcq_validate(set(answer_dict), tentative):
+            return result_dict
+
         # Normalize tentative answer
         tentative = "".join(sorted(tentative.upper().strip()))
         result_dict["answers"][f"{i}"] = tentative
         if dump is not None:
             dump(result_dict)
+        if expired():
+            return result_dict
 
-    def formatted_footer():
-        term = app_session.output.term
-        columns = app_session.output.get_size().columns
-        footer = ANSI(md_render(mcq.footer, term, columns))
-        return to_formatted_text(footer) + to_formatted_text(">>> ")
+    formatted_footer = concat_formatted_text(
+        lambda: renderer.render(mcq.footer), ">>> "
+    )
 
     message = "Optionally enter a comment and exit"
     comment = await prompt_sesion.prompt_async(
         formatted_footer,
         default=result_dict["comment"],
-        bottom_toolbar=lambda: bottom_toolbar(message),
-        swap_light_and_dark_colors=Condition(lambda: swapped),
+        bottom_toolbar=make_bottom_toolbar(app_session, message, countdown),
+        swap_light_and_dark_colors=swap_light_and_dark_colors,
         validator=Validator.from_callable(lambda _: True),
         validate_while_typing=False,
+        pre_run=start_countdown,
     )
     result_dict["comment"] = comment
     if dump is not None:
@@ -124,20 +221,61 @@ async def run_mcq_prompts(app_session, mcq_filename, result_dict, dump=None):
     return result_dict
 
 
-async def run_mcq(mcq_filename, result_dir, username):
-    path = Path(result_dir) / f"{username}.json"
-    await run_mcq_prompts(
-        get_app_session(), mcq_filename, read_json(path), partial(write_json, path)
-    )
+async def run_mcq(
+    mcq_filename,
+    result_dir,
+    username,
+    time_limit=None,
+    deadline=None,
+    profiler=None,
+    store=None,
+):
+    if store is None:
+        store = FileStore(result_dir=result_dir)
+    result_dict = await read_result(store, username)
+    deadline = get_deadline(result_dict, time_limit, deadline)
+    countdown = None if deadline is None else Countdown(deadline)
+    dump = StoreWriter(store, RESULTS, username)
+    if profiler is not None:
+        dump.write = profiler.wrap("save", dump.write)
+    if countdown is not None:
+        dump(result_dict)
+    renderer = MarkdownRenderer(get_app_session())
+    try:
+        await run_mcq_prompts(
+            get_app_session(),
+            mcq_filename,
+            result_dict,
+            dump,
+            countdown,
+            renderer,
+            profiler,
+        )
+    finally:
+        renderer.close()
+        if countdown is not None:
+            countdown.stop()
+        await dump.drain()
 
 
 def main(args=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("--username", "-u", type=str, default="reference")
     parser.add_argument("--result-dir", "-r", type=Path, default=Path("results"))
+    parser.add_argument("--time-limit", "-t", type=float, default=None)
+    parser.add_argument("--deadline", "-d", type=parse_deadline, default=None)
     parser.add_argument("mcq_filename", metavar="MCQ_FILE", type=Path)
     namespace = parser.parse_args(args)
-    asyncio.run(run_mcq(namespace.mcq_filename, namespace.result_dir, namespace.username))
+    time_limit = None if namespace.time_limit is None else namespace.time_limit * 60
+    asyncio.run(
+        run_mcq(
+            namespace.mcq_filename,
+            namespace.result_dir,
+            namespace.username,
+            time_limit=time_limit,
+            deadline=namespace.deadline,
+        )
+    )
 
 
 if __name__ == "__main__":
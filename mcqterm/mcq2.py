@@ -5,17 +5,14 @@ An MCQ prompt-toolkit application.
 import asyncio
 import argparse
 from pathlib import Path
-from functools import partial
 from importlib import resources
 
-from prompt_toolkit import ANSI
 from prompt_toolkit.styles import Style
 from prompt_toolkit.layout import Layout
 from prompt_toolkit.application import Application
 from prompt_toolkit.key_binding import KeyBindings
 from prompt_toolkit.layout.containers import HSplit
 from prompt_toolkit.application import get_app_session
-from prompt_toolkit.formatted_text import to_formatted_text
 from prompt_toolkit.key_binding.bindings.focus import focus_next, focus_previous
 from prompt_toolkit.key_binding.defaults import load_key_bindings, merge_key_bindings
 from prompt_toolkit.widgets import (
@@ -26,7 +23,9 @@ from prompt_toolkit.widgets import (
     TextArea,
 )
 
-from .mcqcommon import parse_mcq, md_render, read_json, write_json
+from .mcqcommon import parse_mcq, MarkdownRenderer
+from .store import FileStore, StoreWriter, RESULTS, SESSIONS, read_result, read_session
+from .deadline import Countdown, get_deadline, parse_deadline
 
 NAME_PROMPT = "Please enter your name"
 BEGIN_TEXT = "Begin"
@@ -47,12 +46,26 @@ STYLE = Style.from_dict(
 
 
 class MCQApp:
-    def __init__(self, app_session, mcq_data, result_dict, dump):
+    def __init__(
+        self,
+        app_session,
+        mcq_data,
+        result_dict,
+        dump,
+        countdown=None,
+        theme="dark",
+        session_dict=None,
+        dump_session=None,
+    ):
         # Set arguments
         self.app_session = app_session
         self.mcq_data = mcq_data
         self.result_dict = result_dict
         self.dump = dump
+        self.countdown = countdown
+        self.theme = theme
+        self.session_dict = {} if session_dict is None else session_dict
+        self.dump_session = dump_session
 
         # Set MCQ data
         self.title = mcq_data.title
@@ -63,10 +76,14 @@ class MCQApp:
             enumerate((answer_dict for _, answer_dict in mcq_data.answers), 1)
         )
 
-        # Set current question
-        self.current = 0
+        # Set current question, resuming the previous session if any
+        current = self.session_dict.get("current", 0)
+        if not isinstance(current, int) or not 0 <= current <= len(self.answers) + 1:
+            current = 0
+        self.current = current
         self.bindings = self._make_bindings()
         self.app = self._make_app(Label(""), self.bindings)
+        self.renderer = MarkdownRenderer(app_session, theme, margin=4, strip=True)
 
         # Inputs
         self.name_input = TextArea(
@@ -82,20 +99,25 @@ class MCQApp:
         self.comment_input.text = self.result_dict["comment"]
         self.cb_list = self._make_cb_list(self.current)
         self.body = self._make_body(self.current, self.cb_list)
-        self.dialog = self._make_dialog(self.current, self.title, self.body)
+        self.dialog = self._make_dialog(self.current, self.formatted_title, self.body)
         self.app.layout = Layout(self.dialog)
         self.app.invalidate()
         self.app.layout.focus(self.dialog)
 
     # Helpers
 
+    def formatted_title(self):
+        if self.countdown is None:
+            return self.title
+        return f"{self.title} ⏱ {self.countdown.text}"
+
+    def start_countdown(self):
+        if self.countdown is not None:
+            self.countdown.start(self.expire_handler, self.app.invalidate)
+
     def render(self, source):
-        term = self.app_session.output.term
-        width = self.app_session.output.get_size().columns - 4
-        with resources.path('mcqterm', 'custom-glow-theme.json') as theme:
-            return to_formatted_text(
-                ANSI(md_render(source, term, width, theme).strip())
-            )
+        # Rendered on every redraw, in order to follow the terminal width
+        return lambda: self.renderer.render(source)
 
     def save(self):
         if self.cb_list is None:
@@ -107,6 +129,11 @@ class MCQApp:
         if self.dump is not None:
             self.dump(self.result_dict)
 
+    def save_session(self):
+        self.session_dict["current"] = self.current
+        if self.dump_session is not None:
+            self.dump_session(self.session_dict)
+
     # Make methods
 
     def _make_cb_list(self, current):
@@ -191,37 +218,109 @@ class MCQApp:
         self.save()
         self.app.exit()
 
+    def expire_handler(self, arg=None):
+        if self.app.is_running and not self.app.is_done:
+            self.exit_handler()
+
     def previous_handler(self, arg=None):
         self.save()
         self.current -= 1
         self.update_dialog()
+        self.save_session()
 
     def next_handler(self, arg=None):
         self.save()
         self.current += 1
         self.update_dialog()
-
-
-async def _run_mcq(app_session, mcq_filename, result_dict, dump=None):
+        self.save_session()
+
+
+async def _run_mcq(
+    app_session,
+    mcq_filename,
+    result_dict,
+    dump=None,
+    countdown=None,
+    profiler=None,
+    session_dict=None,
+    dump_session=None,
+):
     mcq_data = parse_mcq(mcq_filename)
-    mcq_app = MCQApp(app_session, mcq_data, result_dict, dump)
-    await mcq_app.app.run_async()
-
-
-async def run_mcq(mcq_filename, result_dir, username):
-    path = Path(result_dir) / f"{username}.json"
-    await _run_mcq(
-        get_app_session(), mcq_filename, read_json(path), partial(write_json, path)
-    )
+    with resources.path("mcqterm", "custom-glow-theme.json") as theme:
+        mcq_app = MCQApp(
+            app_session,
+            mcq_data,
+            result_dict,
+            dump,
+            countdown,
+            theme,
+            session_dict,
+            dump_session,
+        )
+        if profiler is not None:
+            profiler.attach(mcq_app.app)
+        try:
+            await mcq_app.app.run_async(pre_run=mcq_app.start_countdown)
+        finally:
+            mcq_app.renderer.close()
+
+
+async def run_mcq(
+    mcq_filename,
+    result_dir,
+    username,
+    time_limit=None,
+    deadline=None,
+    profiler=None,
+    store=None,
+):
+    if store is None:
+        store = FileStore(result_dir=result_dir)
+    result_dict = await read_result(store, username)
+    deadline = get_deadline(result_dict, time_limit, deadline)
+    countdown = None if deadline is None else Countdown(deadline)
+    dump = StoreWriter(store, RESULTS, username)
+    if profiler is not None:
+        dump.write = profiler.wrap("save", dump.write)
+    if countdown is not None:
+        dump(result_dict)
+    session_dict = await read_session(store, username)
+    dump_session = StoreWriter(store, SESSIONS, username)
+    try:
+        await _run_mcq(
+            get_app_session(),
+            mcq_filename,
+            result_dict,
+            dump,
+            countdown,
+            profiler,
+            session_dict,
+            dump_session,
+        )
+    finally:
+        if countdown is not None:
+            countdown.stop()
+        await asyncio.gather(dump.drain(), dump_session.drain())
 
 
 def main(args=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("--username", "-u", type=str, default="reference")
     parser.add_argument("--result-dir", "-r", type=Path, default=Path("results"))
+    parser.add_argument("--time-limit", "-t", type=float, default=None)
+    parser.add_argument("--deadline", "-d", type=parse_deadline, default=None)
     parser.add_argument("mcq_filename", metavar="MCQ_FILE", type=Path)
     namespace = parser.parse_args(args)
-    asyncio.run(run_mcq(namespace.mcq_filename, namespace.result_dir, namespace.username))
+    time_limit = None if namespace.time_limit is None else namespace.time_limit * 60
+    asyncio.run(
+        run_mcq(
+            namespace.mcq_filename,
+            namespace.result_dir,
+            namespace.username,
+            time_limit=time_limit,
+            deadline=namespace.deadline,
+        )
+    )
 
 
 if __name__ == "__main__":
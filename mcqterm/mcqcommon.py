@@ -4,22 +4,155 @@ Common helpers for both versions of the MCQ application
 
 import json
 import string
-import functools
+import asyncio
 import subprocess
-from collections import namedtuple
+from collections import defaultdict, namedtuple
+
+import structlog
+
+LOGGER = structlog.get_logger()
+
+RENDER_DELAY = 0.2
+
+# Rendered markdown, indexed by (source, term, theme) then by width
+_RENDER_CACHE = defaultdict(dict)
+
+
+def glow_command(width, theme="dark"):
+    return f"glow -s {theme} -w {width - 3} -"
 
 
-@functools.lru_cache(maxsize=None)
 def md_render(source, term, width, theme="dark"):
-    result = subprocess.run(
-        f"glow -s {theme} -w {width - 3} -",
-        shell=True,
-        capture_output=True,
-        input=source,
-        text=True,
-        env={"TERM": term},
-    )
-    return result.stdout
+    widths = _RENDER_CACHE[source, term, theme]
+    if width not in widths:
+        result = subprocess.run(
+            glow_command(width, theme),
+            shell=True,
+            capture_output=True,
+            input=source,
+            text=True,
+            env={"TERM": term},
+        )
+        widths[width] = result.stdout
+    return widths[width]
+
+
+async def md_render_async(source, term, width, theme="dark"):
+    widths = _RENDER_CACHE[source, term, theme]
+    if width not in widths:
+        process = await asyncio.create_subprocess_shell(
+            glow_command(width, theme),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env={"TERM": term},
+        )
+        try:
+            stdout, _ = await process.communicate(source.encode())
+        except asyncio.CancelledError:
+            if process.returncode is None:
+                process.kill()
+            raise
+        widths[width] = stdout.decode()
+    return widths[width]
+
+
+def md_render_nearest(source, term, width, theme="dark"):
+    widths = _RENDER_CACHE.get((source, term, theme))
+    if not widths:
+        return None
+    return widths[min(widths, key=lambda cached: abs(cached - width))]
+
+
+# When the width changes, the nearest cached width is shown while the actual
+# width is rendered in the background, once it has been stable for a short delay.
+# Background renderings for stale widths are cancelled.
+class MarkdownRenderer:
+    def __init__(self, app_session, theme="dark", margin=0, strip=False):
+        self.app_session = app_session
+        self.theme = theme
+        self.margin = margin
+        self.strip = strip
+        self._width = None
+        self._ansi_cache = {}
+        self._missing = set()
+        self._pending_width = None
+        self._pending_task = None
+
+    def render(self, source):
+        term = self.app_session.output.term
+        width = self.app_session.output.get_size().columns - self.margin
+        if width != self._width:
+            self._width = width
+            self._ansi_cache.clear()
+            # Cancel the background rendering of a stale width, even when
+            # the new width is already cached
+            if self._pending_width is not None and self._pending_width != width:
+                self._cancel()
+        try:
+            return self._ansi_cache[source]
+        except KeyError:
+            pass
+        widths = _RENDER_CACHE.get((source, term, self.theme), {})
+        if width in widths:
+            text = widths[width]
+        else:
+            text = md_render_nearest(source, term, width, self.theme)
+            # Nothing to show yet, render synchronously
+            if text is None:
+                text = md_render(source, term, width, self.theme)
+            # Show the nearest width until the actual width is rendered
+            else:
+                self._schedule(source, term, width)
+                return self._to_ansi(text)
+        ansi = self._ansi_cache[source] = self._to_ansi(text)
+        return ansi
+
+    def close(self):
+        self._cancel()
+
+    def _to_ansi(self, text):
+        # Keep this module importable without loading prompt-toolkit
+        from prompt_toolkit.formatted_text import ANSI
+
+        return ANSI(text.strip() if self.strip else text)
+
+    def _schedule(self, source, term, width):
+        if width != self._pending_width:
+            self._cancel()
+            self._pending_width = width
+        self._missing.add(source)
+        if self._pending_task is None:
+            coro = self._render_missing(term, width)
+            self._pending_task = asyncio.ensure_future(coro)
+
+    def _cancel(self):
+        if self._pending_task is not None:
+            self._pending_task.cancel()
+        self._pending_task = None
+        self._pending_width = None
+        self._missing.clear()
+
+    async def _render_missing(self, term, width):
+        try:
+            await asyncio.sleep(RENDER_DELAY)
+            while self._missing:
+                source = self._missing.pop()
+                await md_render_async(source, term, width, self.theme)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # The nearest width keeps being shown, and the next render retries
+            LOGGER.exception("Failed to render markdown", width=width)
+            self._missing.clear()
+            return
+        finally:
+            # A cancelled task might already have been replaced by a new one
+            if self._pending_task is asyncio.current_task():
+                self._pending_task = None
+                self._pending_width = None
+        if self.app_session.app is not None:
+            self.app_session.app.invalidate()
 
 
 def parse_mcq(filename):
@@ -63,14 +196,13 @@ def read_json(path):
         value = json.loads(path.read_text())
     except (ValueError, json.JSONDecodeError, OSError):
         value = {}
+    return normalize_result(value)
+
+
+def normalize_result(value):
     if not isinstance(value, dict):
         value = {}
     value.setdefault("name", "")
     value.setdefault("answers", {})
     value.setdefault("comment", "")
     return value
-
-
-def write_json(path, value):
-    path.parent.mkdir(parents=True, exist_ok=True)
-    path.write_text(json.dumps(value))
@@ -0,0 +1,81 @@
+"""
+Provide an opt-in per-session profiler.
+
+The key handlers, renders, saves and output flushes of a session are timed,
+and the slow ones are logged. A cProfile capture restricted to those phases
+can also be dumped to a file. Nothing is instrumented when profiling is disabled.
+"""
+
+import time
+import asyncio
+import cProfile
+
+import structlog
+
+LOGGER = structlog.get_logger()
+
+
+class SessionProfiler:
+    def __init__(self, log_info, threshold=None, cprofile_path=None):
+        self.log_info = log_info
+        self.threshold = threshold
+        self.cprofile_path = cprofile_path
+        self.cprofile = None if cprofile_path is None else cProfile.Profile()
+        self._starts = {}
+
+    def start(self, phase):
+        if not self._starts and self.cprofile is not None:
+            self.cprofile.enable()
+        self._starts.setdefault(phase, time.perf_counter())
+
+    def stop(self, phase):
+        # The start might be missing if the phase was interrupted by an exception
+        start = self._starts.pop(phase, None)
+        if not self._starts and self.cprofile is not None:
+            self.cprofile.disable()
+        if start is not None:
+            self.log(phase, time.perf_counter() - start)
+
+    def log(self, phase, duration):
+        if self.threshold is not None and duration > self.threshold:
+            LOGGER.warning(
+                f"Slow {phase} phase",
+                phase=phase,
+                duration_ms=round(duration * 1000, 1),
+                **self.log_info,
+            )
+
+    def wrap(self, phase, func):
+        # Asynchronous phases are only timed, as other sessions might run meanwhile
+        if asyncio.iscoroutinefunction(func):
+
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self.log(phase, time.perf_counter() - start)
+
+            return async_wrapper
+
+        def wrapper(*args, **kwargs):
+            self.start(phase)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.stop(phase)
+
+        return wrapper
+
+    def attach(self, app):
+        app.key_processor.before_key_press += lambda _: self.start("key")
+        app.key_processor.after_key_press += lambda _: self.stop("key")
+        app.before_render += lambda _: self.start("render")
+        app.after_render += lambda _: self.stop("render")
+
+    def close(self):
+        if self.cprofile is None:
+            return
+        self.cprofile_path.parent.mkdir(parents=True, exist_ok=True)
+        self.cprofile.dump_stats(self.cprofile_path)
+        LOGGER.info(f"Profile written to {self.cprofile_path}", **self.log_info)
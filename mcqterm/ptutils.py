@@ -3,13 +3,18 @@ Provide an async context manager to create a prompt-toolkit app session
 from an AsyncSSH process.
 """
 
+import os
+import asyncio
 from contextlib import asynccontextmanager, contextmanager
 
+from asyncssh import BreakReceived, SignalReceived, TerminalSizeChanged
 from prompt_toolkit.data_structures import Size
 from prompt_toolkit.input import create_pipe_input
 from prompt_toolkit.output.vt100 import Vt100_Output
 from prompt_toolkit.application.current import create_app_session
 
+RESIZE_INTERVAL = 0.1
+
 
 class StdoutFromProcess:
     def __init__(self, process):
@@ -36,13 +41,60 @@ class StdoutFromProcess:
 def vt100_output_from_process(process):
     stdout = StdoutFromProcess(process)
     term = process.get_terminal_type()
-    return Vt100_Output(stdout, stdout.get_size, term=term, write_binary=False)
+    try:
+        return Vt100_Output(stdout, stdout.get_size, term=term, write_binary=False)
+    # The write_binary argument was removed in recent prompt-toolkit versions
+    except TypeError:
+        return Vt100_Output(stdout, stdout.get_size, term=term)
 
 
-async def vt100_input_from_process(process):
+@contextmanager
+def pipe_input():
+    # Since prompt-toolkit 3.0.29, create_pipe_input returns a context manager,
+    # and closing the input only closes the write end of the pipe, once
     vt100_input = create_pipe_input()
-    await process.redirect_stdin(vt100_input._w)
-    return vt100_input
+    if not hasattr(vt100_input, "send_text"):
+        with vt100_input as vt100_input:
+            yield vt100_input
+        return
+
+    # Before that, closing the input closes both ends, so emulate the new behavior
+    read_fd, write_fd = vt100_input._r, vt100_input._w
+    write_closed = False
+
+    def close():
+        nonlocal write_closed
+        if not write_closed:
+            write_closed = True
+            os.close(write_fd)
+
+    vt100_input.close = close
+    try:
+        yield vt100_input
+    finally:
+        close()
+        os.close(read_fd)
+
+
+async def forward_input(process, vt100_input, recorder=None):
+    # The input is forwarded rather than redirected, as a redirection
+    # takes ownership of the pipe and can not go through the recorder
+    try:
+        while True:
+            # Like a redirection, ignore the resizes, breaks and signals
+            # raised by the read: resizes are handled separately
+            try:
+                data = await process.stdin.read(4096)
+            except (TerminalSizeChanged, BreakReceived, SignalReceived):
+                continue
+            if not data:
+                break
+            if recorder is not None:
+                recorder.record_input(data)
+            vt100_input.send_text(data)
+    finally:
+        # Let the application get an EOFError
+        vt100_input.close()
 
 
 @contextmanager
@@ -60,12 +112,25 @@ def disable_line_mode(process):
 
 
 @contextmanager
-def bind_resize_process_to_app_session(process, app_session):
+def bind_resize_process_to_app_session(process, app_session, recorder=None):
     original_method = process.terminal_size_changed
+    loop = asyncio.get_running_loop()
+    handle = None
 
-    def terminal_size_changed(*args):
+    # Coalesce bursts of resize events into a single redraw with the latest size
+    def on_resize():
+        nonlocal handle
+        handle = None
         if app_session.app is not None:
             app_session.app._on_resize()
+
+    def terminal_size_changed(*args):
+        nonlocal handle
+        if recorder is not None:
+            width, height, *_ = args
+            recorder.record_resize(width, height)
+        if handle is None:
+            handle = loop.call_later(RESIZE_INTERVAL, on_resize)
         return original_method(*args)
 
     try:
@@ -73,13 +138,30 @@ def bind_resize_process_to_app_session(process, app_session):
         yield
     finally:
         del process.terminal_size_changed
+        if handle is not None:
+            handle.cancel()
 
 
 @asynccontextmanager
-async def process_to_app_session(process):
+async def process_to_app_session(process, profiler=None, recorder=None):
     vt100_output = vt100_output_from_process(process)
-    vt100_input = await vt100_input_from_process(process)
-    with disable_line_mode(process):
-        with create_app_session(input=vt100_input, output=vt100_output) as app_session:
-            with bind_resize_process_to_app_session(process, app_session):
-                yield app_session
+    if profiler is not None:
+        vt100_output.flush = profiler.wrap("flush", vt100_output.flush)
+    if recorder is not None:
+        vt100_output.stdout.write = recorder.wrap_output(vt100_output.stdout.write)
+    with pipe_input() as vt100_input:
+        forward_task = asyncio.ensure_future(
+            forward_input(process, vt100_input, recorder)
+        )
+        try:
+            with disable_line_mode(process):
+                with create_app_session(
+                    input=vt100_input, output=vt100_output
+                ) as app_session:
+                    with bind_resize_process_to_app_session(
+                        process, app_session, recorder
+                    ):
+                        yield app_session
+        finally:
+            forward_task.cancel()
+            await asyncio.gather(forward_task, return_exceptions=True)
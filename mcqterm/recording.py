@@ -0,0 +1,244 @@
+"""
+Record SSH sessions to a compact binary log, and replay them headlessly.
+
+A log starts with a magic string, followed by records made of a header
+(record type, seconds since the start of the session, payload length) and
+a payload. Only the input is recorded verbatim: resize events are stored
+as terminal sizes and outputs as byte counts.
+
+The replay drives the application from the log, against an output that
+only counts the bytes, and reports the processing time and output volume
+of every event. This turns real exam traffic into a repeatable benchmark.
+"""
+
+import sys
+import time
+import struct
+import asyncio
+import argparse
+import statistics
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+MAGIC = b"MCQREC1\n"
+HEADER = struct.Struct("<BdI")
+SIZE = struct.Struct("<HH")
+COUNT = struct.Struct("<I")
+
+START, INPUT, RESIZE, OUTPUT = range(4)
+RECORD_NAMES = {START: "start", INPUT: "input", RESIZE: "resize", OUTPUT: "output"}
+
+
+class SessionRecorder:
+    def __init__(self, path, term, columns, rows, encoding="utf-8"):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.encoding = encoding
+        self._file = open(self.path, "wb")
+        self._file.write(MAGIC)
+        self._start = time.monotonic()
+        self.record(START, SIZE.pack(columns, rows) + (term or "").encode())
+
+    def record(self, record_type, payload=b""):
+        if self._file is None:
+            return
+        timestamp = time.monotonic() - self._start
+        self._file.write(HEADER.pack(record_type, timestamp, len(payload)))
+        self._file.write(payload)
+
+    def record_input(self, data):
+        self.record(INPUT, data.encode(self.encoding, "replace"))
+
+    def record_resize(self, columns, rows):
+        self.record(RESIZE, SIZE.pack(columns, rows))
+
+    def record_output(self, data):
+        self.record(OUTPUT, COUNT.pack(len(data.encode(self.encoding, "replace"))))
+
+    def wrap_output(self, write):
+        def recorded_write(data):
+            self.record_output(data)
+            return write(data)
+
+        return recorded_write
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def iter_records(path):
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a session recording")
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            record_type, timestamp, length = HEADER.unpack(header)
+            payload = f.read(length)
+            if record_type == START:
+                columns, rows = SIZE.unpack_from(payload)
+                value = columns, rows, payload[SIZE.size :].decode()
+            elif record_type == INPUT:
+                value = payload.decode("utf-8", "replace")
+            elif record_type == RESIZE:
+                value = SIZE.unpack(payload)
+            elif record_type == OUTPUT:
+                (value,) = COUNT.unpack(payload)
+            else:
+                continue
+            yield record_type, timestamp, value
+
+
+# Replay
+
+
+class CountingStdout:
+    def __init__(self, encoding="utf-8"):
+        self.encoding = encoding
+        self.count = 0
+
+    def write(self, data):
+        self.count += len(data.encode(self.encoding, "replace"))
+
+    def isatty(self):
+        return True
+
+    def flush(self):
+        pass
+
+
+async def wait_for_app(app_session, task):
+    while not task.done():
+        app = app_session.app
+        if app is not None and app.is_running and not app.is_done:
+            return app
+        await asyncio.sleep(0.001)
+    return None
+
+
+async def wait_for_redraw(app, task):
+    # Let the event loop run the redraws scheduled by the event
+    while app._invalidated and app.is_running and not task.done():
+        await asyncio.sleep(0)
+
+
+async def replay_session(log_path, mcq_filename, app_version=2, realtime=False):
+    from prompt_toolkit.data_structures import Size
+    from prompt_toolkit.output.vt100 import Vt100_Output
+    from prompt_toolkit.input.vt100_parser import Vt100Parser
+    from prompt_toolkit.application.current import create_app_session
+
+    from .store import FileStore
+    from .ptutils import pipe_input
+    from .server import load_run_mcq
+
+    records = iter_records(log_path)
+    record_type, _, (columns, rows, term) = next(records)
+    assert record_type == START
+    size = Size(rows=rows, columns=columns)
+    stdout = CountingStdout()
+    try:
+        output = Vt100_Output(stdout, lambda: size, term=term, write_binary=False)
+    # The write_binary argument was removed in recent prompt-toolkit versions
+    except TypeError:
+        output = Vt100_Output(stdout, lambda: size, term=term)
+    run_mcq = load_run_mcq(app_version)
+    key_presses = []
+    parser = Vt100Parser(key_presses.append)
+    events = []
+    recorded_output = 0
+
+    with pipe_input() as vt100_input, TemporaryDirectory() as tmp:
+        with create_app_session(input=vt100_input, output=output) as app_session:
+            store = FileStore(Path(tmp) / "authorized_keys", Path(tmp) / "results")
+            task = asyncio.ensure_future(
+                run_mcq(mcq_filename, None, "replay", store=store)
+            )
+            start = time.monotonic()
+            for record_type, timestamp, value in records:
+                if record_type == OUTPUT:
+                    recorded_output += value
+                if record_type not in (INPUT, RESIZE):
+                    continue
+                if realtime:
+                    await asyncio.sleep(timestamp - (time.monotonic() - start))
+                app = await wait_for_app(app_session, task)
+                if app is None:
+                    break
+                await wait_for_redraw(app, task)
+                before = stdout.count
+                event_start = time.perf_counter()
+                if record_type == INPUT:
+                    parser.feed(value)
+                    parser.flush()
+                    app.key_processor.feed_multiple(key_presses)
+                    key_presses.clear()
+                    app.key_processor.process_keys()
+                else:
+                    size = Size(rows=value[1], columns=value[0])
+                    app._on_resize()
+                await wait_for_redraw(app, task)
+                duration = time.perf_counter() - event_start
+                events.append((record_type, timestamp, duration, stdout.count - before))
+            if not task.done():
+                task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+    return events, recorded_output
+
+
+def report(events, recorded_output, verbose=False, file=sys.stdout):
+    if verbose:
+        for record_type, timestamp, duration, count in events:
+            print(
+                f"{timestamp:10.3f}s {RECORD_NAMES[record_type]:>6} "
+                f"{duration * 1000:8.3f} ms {count:8d} bytes",
+                file=file,
+            )
+    for record_type in (INPUT, RESIZE):
+        durations = [d * 1000 for t, _, d, _ in events if t == record_type]
+        counts = [c for t, _, _, c in events if t == record_type]
+        if not durations:
+            continue
+        p95 = durations[0]
+        if len(durations) > 1:
+            p95 = statistics.quantiles(durations, n=20, method="inclusive")[-1]
+        print(
+            f"{RECORD_NAMES[record_type]}: {len(durations)} events, "
+            f"mean {statistics.mean(durations):.3f} ms, "
+            f"median {statistics.median(durations):.3f} ms, "
+            f"p95 {p95:.3f} ms, max {max(durations):.3f} ms, "
+            f"{sum(counts)} bytes of output",
+            file=file,
+        )
+    replayed_output = sum(count for _, _, _, count in events)
+    print(
+        f"output: {replayed_output} bytes replayed, {recorded_output} bytes recorded",
+        file=file,
+    )
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog="mcqterm replay")
+    parser.add_argument("--app-version", "-v", type=int, default=2)
+    parser.add_argument("--realtime", action="store_true")
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument("log_filename", metavar="LOG_FILE", type=Path)
+    parser.add_argument("mcq_filename", metavar="MCQ_FILE", type=Path)
+    namespace = parser.parse_args(args)
+    assert namespace.app_version in (1, 2)
+    events, recorded_output = asyncio.run(
+        replay_session(
+            namespace.log_filename,
+            namespace.mcq_filename,
+            namespace.app_version,
+            namespace.realtime,
+        )
+    )
+    report(events, recorded_output, namespace.verbose)
+
+
+if __name__ == "__main__":
+    main()
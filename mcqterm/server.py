@@ -2,48 +2,175 @@
 An SSH server running the MCQ terminal application.
 """
 
+import sys
+import json
+import time
 import asyncio
 import argparse
+import resource
+import importlib
 from pathlib import Path
 
 import structlog
 
-from .mcq import run_mcq as run_mcq_v1
-from .mcq2 import run_mcq as run_mcq_v2
-from .ptutils import process_to_app_session
+from .deadline import parse_deadline
+from .store import open_store, read_secret
 from .ssh import create_user_claimable_ssh_server
 
 LOGGER = structlog.get_logger()
 
+# The application modules pull in most of prompt-toolkit,
+# so only the selected one is imported, on first use
+APP_MODULES = {1: "mcqterm.mcq", 2: "mcqterm.mcq2"}
+
+
+def profile_startup(message):
+    # Process time includes the interpreter startup and all the imports
+    cpu_time = time.process_time() * 1000
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        max_rss //= 1024
+    print(
+        f"{message} ({cpu_time:.1f} ms of CPU time, "
+        f"{max_rss / 1024:.1f} MiB of max RSS, "
+        f"{len(sys.modules)} modules imported)"
+    )
+
+
+def load_run_mcq(app_version, profile=False):
+    name = APP_MODULES[app_version]
+    if profile and name not in sys.modules:
+        start = time.perf_counter()
+        importlib.import_module(name)
+        elapsed = (time.perf_counter() - start) * 1000
+        profile_startup(f"Imported {name} in {elapsed:.1f} ms")
+    return importlib.import_module(name).run_mcq
+
+
+def read_time_limits(parser, path):
+    # Reject invalid files at startup, rather than when the candidate connects
+    try:
+        time_limits = json.loads(path.read_text())
+    except (OSError, ValueError) as exc:
+        parser.error(f"invalid time limits file {str(path)!r}: {exc}")
+    if not isinstance(time_limits, dict):
+        parser.error(f"time limits file {str(path)!r} is not a JSON object")
+    for username, time_limit in time_limits.items():
+        if (
+            isinstance(time_limit, bool)
+            or not isinstance(time_limit, (int, float))
+            or time_limit <= 0
+        ):
+            parser.error(
+                f"invalid time limit for {username!r}: {time_limit!r} "
+                "(expected a positive number of minutes)"
+            )
+    return time_limits
+
+
+def get_time_limit(config, username):
+    # Per-candidate time limits, in minutes, override the per-exam time limit
+    time_limit = config.time_limits.get(username, config.time_limit)
+    if time_limit is None:
+        return None
+    return time_limit * 60
+
+
+def get_session_name(username, log_info):
+    # The peer port tells apart the sessions started in the same second
+    timestamp = time.strftime("%Y%m%d-%H%M%S")
+    return f"{username}-{timestamp}-{log_info.get('peer_port', 0)}"
+
+
+def get_cprofile_users(config):
+    # The users file is watched, so captures can be turned on during the exam
+    path = config.cprofile_users_file
+    try:
+        mtime = None if path is None else path.stat().st_mtime
+    except OSError:
+        mtime = None
+    if mtime != config.cprofile_users_mtime:
+        config.cprofile_users_mtime = mtime
+        users = () if mtime is None else path.read_text().split()
+        config.watched_cprofile_users = set(users)
+    return config.cprofile_users | config.watched_cprofile_users
+
+
+def get_profiler(config, username, log_info):
+    cprofile_path = None
+    if username in get_cprofile_users(config):
+        session_name = get_session_name(username, log_info)
+        cprofile_path = config.cprofile_dir / f"{session_name}.prof"
+    threshold = config.profile_threshold
+    if threshold is None and cprofile_path is None:
+        return None
+    if threshold is not None:
+        threshold /= 1000
+    # Only imported when profiling, as it pulls in cProfile
+    from .profiling import SessionProfiler
+
+    return SessionProfiler(log_info, threshold, cprofile_path)
+
+
+def get_recorder(config, process, username, log_info):
+    if config.record_dir is None:
+        return None
+    session_name = get_session_name(username, log_info)
+    path = config.record_dir / f"{session_name}.mcqrec"
+    width, height, _, _ = process.get_terminal_size()
+    from .recording import SessionRecorder
+
+    return SessionRecorder(path, process.get_terminal_type(), width, height)
+
 
 async def run_mcq_in_ssh_process(process):
     log_info = process.get_extra_info("log_info")
+    config = process.get_extra_info("extra_config")
+    store = process.get_extra_info("store")
+    run_mcq = load_run_mcq(config.app_version, config.profile_startup)
 
-    # AsyncSSH process to prompt-toolkit app session
-    async with process_to_app_session(process):
-
-        # Run a prompt-toolkit application
-        try:
-            config = process.get_extra_info("extra_config")
-            username = process.get_extra_info("username")
-            run_mcq = run_mcq_v1 if config.app_version == 1 else run_mcq_v2
-            result = await run_mcq(config.mcq_filename, config.result_dir, username)
-
-        # Make sure dangerous exceptions do not leak out of the app session
-        except KeyboardInterrupt:
-            LOGGER.info("User exited with a keyboard interrupt", **log_info)
-            return 1
-        except EOFError:
-            LOGGER.info("User exited by closing the stream", **log_info)
-            return 1
-        except SystemExit:
-            LOGGER.info("User exited by closing the stream", **log_info)
-            return 1
-        except Exception:
-            LOGGER.exception("User exited with an unexpected error", **log_info)
-            return 1
-        else:
-            LOGGER.info(f"User exited with result {result!r}", **log_info)
+    # Deferred until the first session, as it imports prompt-toolkit
+    from .ptutils import process_to_app_session
+
+    username = process.get_extra_info("username")
+    profiler = get_profiler(config, username, log_info)
+    recorder = get_recorder(config, process, username, log_info)
+    try:
+        # AsyncSSH process to prompt-toolkit app session
+        async with process_to_app_session(process, profiler, recorder):
+
+            # Run a prompt-toolkit application
+            try:
+                result = await run_mcq(
+                    config.mcq_filename,
+                    config.result_dir,
+                    username,
+                    time_limit=get_time_limit(config, username),
+                    deadline=config.deadline,
+                    profiler=profiler,
+                    store=store,
+                )
+
+            # Make sure dangerous exceptions do not leak out of the app session
+            except KeyboardInterrupt:
+                LOGGER.info("User exited with a keyboard interrupt", **log_info)
+                return 1
+            except EOFError:
+                LOGGER.info("User exited by closing the stream", **log_info)
+                return 1
+            except SystemExit:
+                LOGGER.info("User exited by closing the stream", **log_info)
+                return 1
+            except Exception:
+                LOGGER.exception("User exited with an unexpected error", **log_info)
+                return 1
+            else:
+                LOGGER.info(f"User exited with result {result!r}", **log_info)
+    finally:
+        if profiler is not None:
+            profiler.close()
+        if recorder is not None:
+            recorder.close()
 
     # Cast the result to an integer
     try:
@@ -68,6 +195,12 @@ async def run_mcq_ssh_server(
         server_host_key = Path("~/.ssh/id_rsa").expanduser()
     if authorized_keys_dir is None:
         authorized_keys_dir = Path("authorized_keys")
+    store = open_store(
+        getattr(extra_config, "store", None),
+        authorized_keys_dir,
+        getattr(extra_config, "result_dir", None),
+        read_secret(getattr(extra_config, "store_secret_file", None)),
+    )
 
     server = await create_user_claimable_ssh_server(
         run_mcq_in_ssh_process,
@@ -78,8 +211,11 @@ async def run_mcq_ssh_server(
         server_host_keys=[server_host_key],
         authorized_keys_dir=authorized_keys_dir,
         extra_config=extra_config,
+        store=store,
     )
     bind, port = server.sockets[0].getsockname()
+    if extra_config is not None and extra_config.profile_startup:
+        profile_startup("Server started")
     print(f"Running an SSH server on {bind}:{port}...")
 
     while True:
@@ -87,6 +223,21 @@ async def run_mcq_ssh_server(
 
 
 def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    if args[:1] == ["export"]:
+        from .export import main as export_main
+
+        return export_main(args[1:])
+    if args[:1] == ["coordinator"]:
+        from .store import main as coordinator_main
+
+        return coordinator_main(args[1:])
+    if args[:1] == ["replay"]:
+        from .recording import main as replay_main
+
+        return replay_main(args[1:])
+
     parser = argparse.ArgumentParser()
     parser.add_argument("--port", "-p", type=int, default=8022)
     parser.add_argument("--bind", "-b", type=str, default="localhost")
@@ -97,11 +248,28 @@ def main(args=None):
     )
     parser.add_argument("--server-host-key", "-s", type=Path, default=None)
     parser.add_argument("--result-dir", "-r", type=Path, default=Path("results"))
+    parser.add_argument("--store", type=str, default="files")
+    parser.add_argument("--store-secret-file", type=Path, default=None)
     parser.add_argument("--app-version", "-v", type=int, default=2)
+    parser.add_argument("--time-limit", "-t", type=float, default=None)
+    parser.add_argument("--time-limits-file", "-T", type=Path, default=None)
+    parser.add_argument("--deadline", "-d", type=parse_deadline, default=None)
+    parser.add_argument("--profile-startup", action="store_true")
+    parser.add_argument("--profile-threshold", type=float, default=None)
+    parser.add_argument("--cprofile-user", dest="cprofile_users", action="append")
+    parser.add_argument("--cprofile-users-file", type=Path, default=None)
+    parser.add_argument("--cprofile-dir", type=Path, default=Path("profiles"))
+    parser.add_argument("--record-dir", type=Path, default=None)
     parser.add_argument("mcq_filename", metavar="MCQ_FILE", type=Path)
     namespace = parser.parse_args(args)
     assert namespace.mcq_filename.exists()
     assert namespace.app_version in (1, 2)
+    namespace.cprofile_users = set(namespace.cprofile_users or ())
+    namespace.cprofile_users_mtime = None
+    namespace.watched_cprofile_users = set()
+    namespace.time_limits = {}
+    if namespace.time_limits_file is not None:
+        namespace.time_limits = read_time_limits(parser, namespace.time_limits_file)
     return asyncio.run(
         run_mcq_ssh_server(
             bind=namespace.bind,
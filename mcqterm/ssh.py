@@ -7,6 +7,8 @@ import structlog
 
 from pathvalidate import sanitize_filename
 
+from .store import AUTHORIZED_KEYS, FileStore
+
 LOGGER = structlog.get_logger()
 
 ADD_AUTHORIZED_KEYS_HELP = """\
@@ -40,14 +42,14 @@ class UserClaimableSSHServer(asyncssh.SSHServer):
         authenticated_process_factory,
         user_claim_password,
         external_address,
-        authorized_keys_dir,
+        store,
         extra_config,
     ):
         self._log_info = {}
         self._extra_config = extra_config
         self._external_address = external_address
         self._user_claim_password = user_claim_password
-        self._authorized_keys_dir = authorized_keys_dir
+        self._store = store
         self._authenticated_process_factory = authenticated_process_factory
 
     def connection_made(self, conn):
@@ -55,18 +57,27 @@ class UserClaimableSSHServer(asyncssh.SSHServer):
         self._conn.set_extra_info(log_info=self._log_info)
         self._conn.set_extra_info(extra_config=self._extra_config)
         self._conn.set_extra_info(external_address=self._external_address)
+        self._conn.set_extra_info(store=self._store)
         peername = conn.get_extra_info("peername")
         self._log_info["peer_hostname"], self._log_info["peer_port"] = peername
         LOGGER.info(f"Connection made", **self._log_info)
 
-    def begin_auth(self, username):
+    async def begin_auth(self, username):
         username = sanitize_filename(username)
         self._log_info["username"] = username
         LOGGER.info(f"Begin authentification", **self._log_info)
+        # Read the keys from the store, so claims made on other nodes apply
         try:
-            self._conn.set_authorized_keys(f"./authorized_keys/{username}")
-        except (OSError, ValueError):
-            pass
+            authorized_keys = await self._store.get(AUTHORIZED_KEYS, username)
+        except Exception:
+            LOGGER.exception("Failed to read the authorized keys", **self._log_info)
+            authorized_keys = None
+        if authorized_keys:
+            try:
+                authorized_keys = asyncssh.import_authorized_keys(authorized_keys)
+                self._conn.set_authorized_keys(authorized_keys)
+            except ValueError:
+                pass
         return True
 
     def password_auth_supported(self):
@@ -115,10 +126,8 @@ class UserClaimableSSHServer(asyncssh.SSHServer):
             stdin = await process.stdin.read()
             if not stdin.endswith("\n"):
                 stdin += "\n"
-            filename = sanitize_filename(username)
-            self._authorized_keys_dir.mkdir(parents=True, exist_ok=True)
-            with open(self._authorized_keys_dir / filename, "a") as f:
-                f.write(stdin)
+            username = sanitize_filename(username)
+            await self._store.append(AUTHORIZED_KEYS, username, stdin)
             return process.exit(0)
 
         # Unsupported command
@@ -163,13 +172,17 @@ async def create_user_claimable_ssh_server(
     server_host_keys=[],
     authorized_keys_dir=None,
     extra_config=None,
+    store=None,
 ):
+    if store is None:
+        store = FileStore(authorized_keys_dir or "authorized_keys")
+
     def instanciate_ssh_server():
         return UserClaimableSSHServer(
             authenticated_process_factory,
             user_claim_password=user_claim_password,
             external_address=external_address,
-            authorized_keys_dir=authorized_keys_dir,
+            store=store,
             extra_config=extra_config,
         )
 
@@ -0,0 +1,505 @@
+"""
+Provide pluggable stores for the authorized keys, session states and results.
+
+A single server uses the file store. Several server processes on the same host
+can share a SQLite store, and server processes on several hosts can share a
+store served by a coordinator process over TCP.
+"""
+
+import os
+import copy
+import hmac
+import json
+import bisect
+import asyncio
+import argparse
+from pathlib import Path
+from abc import ABC, abstractmethod
+
+import structlog
+from pathvalidate import sanitize_filename
+
+from .mcqcommon import normalize_result
+
+LOGGER = structlog.get_logger()
+
+AUTHORIZED_KEYS = "authorized_keys"
+SESSIONS = "sessions"
+RESULTS = "results"
+KINDS = (AUTHORIZED_KEYS, SESSIONS, RESULTS)
+
+COORDINATOR_PORT = 8023
+SCAN_LIMIT = 256
+RETRY_DELAY = 0.1
+RETRY_MAX_DELAY = 5.0
+DRAIN_TIMEOUT = 30.0
+LOCAL_ADDRESSES = ("localhost", "127.0.0.1", "::1")
+
+
+def check_username(username):
+    # Usernames are used as file names, and come from the network in cluster mode
+    if (
+        not isinstance(username, str)
+        or not username
+        or username.startswith(".")
+        or sanitize_filename(username) != username
+    ):
+        raise ValueError(f"Invalid username: {username!r}")
+    return username
+
+
+def read_secret(path):
+    return None if path is None else Path(path).read_text().strip()
+
+
+class Store(ABC):
+    # Authorized keys are stored as text, sessions and results as JSON values
+
+    @abstractmethod
+    async def get(self, kind, username):
+        pass
+
+    @abstractmethod
+    async def set(self, kind, username, value):
+        pass
+
+    @abstractmethod
+    async def append(self, kind, username, text):
+        pass
+
+    @abstractmethod
+    async def scan(self, kind, after=None, limit=SCAN_LIMIT):
+        # Return up to limit [username, value] pairs, ordered by username
+        pass
+
+    async def iter_items(self, kind):
+        # Stream all the values of a kind, one page at a time
+        after = None
+        while True:
+            items = await self.scan(kind, after)
+            if not items:
+                return
+            for username, value in items:
+                yield username, value
+            after = items[-1][0]
+
+    async def close(self):
+        pass
+
+
+class FileStore(Store):
+    def __init__(
+        self,
+        authorized_keys_dir=Path("authorized_keys"),
+        result_dir=Path("results"),
+        session_dir=None,
+    ):
+        if session_dir is None:
+            session_dir = Path(result_dir) / ".sessions"
+        self.dirs = {
+            AUTHORIZED_KEYS: Path(authorized_keys_dir),
+            SESSIONS: Path(session_dir),
+            RESULTS: Path(result_dir),
+        }
+
+    def _path(self, kind, username):
+        check_username(username)
+        if kind == AUTHORIZED_KEYS:
+            return self.dirs[kind] / username
+        return self.dirs[kind] / f"{username}.json"
+
+    async def get(self, kind, username):
+        try:
+            data = self._path(kind, username).read_text()
+        except OSError:
+            return None
+        if kind == AUTHORIZED_KEYS:
+            return data
+        try:
+            return json.loads(data)
+        except ValueError:
+            return None
+
+    async def set(self, kind, username, value):
+        path = self._path(kind, username)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(value if kind == AUTHORIZED_KEYS else json.dumps(value))
+
+    async def append(self, kind, username, text):
+        path = self._path(kind, username)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "a") as f:
+            f.write(text)
+
+    def _usernames(self, kind):
+        suffix = "" if kind == AUTHORIZED_KEYS else ".json"
+        try:
+            entries = os.scandir(self.dirs[kind])
+        except FileNotFoundError:
+            return []
+        with entries:
+            return sorted(
+                entry.name[: len(entry.name) - len(suffix)]
+                for entry in entries
+                if entry.name.endswith(suffix)
+                and not entry.name.startswith(".")
+                and entry.is_file()
+            )
+
+    async def scan(self, kind, after=None, limit=SCAN_LIMIT):
+        usernames = self._usernames(kind)
+        start = 0 if after is None else bisect.bisect_right(usernames, after)
+        return [
+            [username, await self.get(kind, username)]
+            for username in usernames[start : start + limit]
+        ]
+
+
+class SQLiteStore(Store):
+    # The database is accessed from a single thread, outside of the event loop.
+    # The sqlite3 and thread pool modules are only imported when this store is used
+
+    def __init__(self, path):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.path = path
+        self._executor = ThreadPoolExecutor(1)
+        self._connection = None
+
+    def _connect(self):
+        if self._connection is None:
+            import sqlite3
+
+            self._connection = sqlite3.connect(self.path, timeout=30)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS store ("
+                "kind TEXT, username TEXT, value TEXT, PRIMARY KEY (kind, username))"
+            )
+        return self._connection
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _get(self, kind, username):
+        row = (
+            self._connect()
+            .execute(
+                "SELECT value FROM store WHERE kind = ? AND username = ?",
+                (kind, username),
+            )
+            .fetchone()
+        )
+        return None if row is None else json.loads(row[0])
+
+    def _set(self, kind, username, value):
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO store VALUES (?, ?, ?)",
+                (kind, username, json.dumps(value)),
+            )
+
+    def _scan(self, kind, after, limit):
+        rows = (
+            self._connect()
+            .execute(
+                "SELECT username, value FROM store WHERE kind = ? AND username > ? "
+                "ORDER BY username LIMIT ?",
+                (kind, "" if after is None else after, limit),
+            )
+            .fetchall()
+        )
+        return [[username, json.loads(value)] for username, value in rows]
+
+    def _append(self, kind, username, text):
+        connection = self._connect()
+        with connection:
+            # Lock the database, as other processes might append concurrently
+            connection.execute("BEGIN IMMEDIATE")
+            value = self._get(kind, username) or ""
+            connection.execute(
+                "INSERT OR REPLACE INTO store VALUES (?, ?, ?)",
+                (kind, username, json.dumps(value + text)),
+            )
+
+    async def get(self, kind, username):
+        return await self._run(self._get, kind, username)
+
+    async def set(self, kind, username, value):
+        await self._run(self._set, kind, username, value)
+
+    async def append(self, kind, username, text):
+        await self._run(self._append, kind, username, text)
+
+    async def scan(self, kind, after=None, limit=SCAN_LIMIT):
+        return await self._run(self._scan, kind, after, limit)
+
+    async def close(self):
+        if self._connection is not None:
+            await self._run(self._connection.close)
+        self._executor.shutdown()
+
+
+class CoordinatorStore(Store):
+    # Line-delimited JSON requests over a single TCP connection,
+    # after a first line carrying the shared secret
+
+    def __init__(self, host="localhost", port=COORDINATOR_PORT, secret=None):
+        self.host = host
+        self.port = port
+        self.secret = secret
+        self._writer = None
+        self._reader_task = None
+        self._connect_lock = None
+        self._pending = {}
+        self._next_id = 0
+
+    async def _connect(self):
+        # The lock is created here, to be bound to the running loop
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self._writer is None:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+                writer.write(json.dumps({"secret": self.secret}).encode() + b"\n")
+                response = json.loads(await reader.readline() or "{}")
+                if not response.get("authenticated"):
+                    writer.close()
+                    raise ConnectionError("The coordinator rejected the secret")
+                self._reader_task = asyncio.ensure_future(self._read_responses(reader))
+                self._writer = writer
+            return self._writer
+
+    async def _read_responses(self, reader):
+        try:
+            async for line in reader:
+                response = json.loads(line)
+                future = self._pending.pop(response["id"], None)
+                if future is None or future.done():
+                    continue
+                if "error" in response:
+                    future.set_exception(RuntimeError(response["error"]))
+                else:
+                    future.set_result(response["result"])
+        finally:
+            # Fail the pending requests, the next request reconnects
+            self._writer = None
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Lost the coordinator"))
+            self._pending.clear()
+
+    async def _request(self, method, *args):
+        writer = await self._connect()
+        self._next_id += 1
+        request_id = self._next_id
+        future = self._pending[request_id] = asyncio.get_running_loop().create_future()
+        request = {"id": request_id, "method": method, "args": args}
+        writer.write(json.dumps(request).encode() + b"\n")
+        await writer.drain()
+        return await future
+
+    async def get(self, kind, username):
+        return await self._request("get", kind, username)
+
+    async def set(self, kind, username, value):
+        await self._request("set", kind, username, value)
+
+    async def append(self, kind, username, text):
+        await self._request("append", kind, username, text)
+
+    async def scan(self, kind, after=None, limit=SCAN_LIMIT):
+        return await self._request("scan", kind, after, limit)
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        if self._reader_task is not None:
+            await asyncio.gather(self._reader_task, return_exceptions=True)
+
+
+class StoreWriter:
+    # Writes are scheduled from synchronous code, and coalesced when
+    # a write is still in progress so only the latest value gets written.
+    # Failed writes are retried with a backoff, until a newer value replaces them
+
+    def __init__(self, store, kind, username):
+        self.store = store
+        self.kind = kind
+        self.username = username
+        self._value = None
+        self._error = None
+        self._task = None
+
+    def __call__(self, value):
+        self._value = copy.deepcopy(value)
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._write())
+
+    async def write(self, value):
+        await self.store.set(self.kind, self.username, value)
+
+    async def _write(self):
+        delay = RETRY_DELAY
+        try:
+            while self._value is not None:
+                value = self._value
+                try:
+                    await self.write(value)
+                except Exception as exc:
+                    self._error = exc
+                    LOGGER.warning(
+                        f"Failed to write to the {self.kind} store, "
+                        f"retrying in {delay:.1f} s",
+                        username=self.username,
+                        error=repr(exc),
+                    )
+                    await asyncio.sleep(delay)
+                    delay = min(2 * delay, RETRY_MAX_DELAY)
+                    continue
+                delay = RETRY_DELAY
+                self._error = None
+                # Values are copied, so a newer value is another object
+                if self._value is value:
+                    self._value = None
+        finally:
+            self._task = None
+
+    async def drain(self, timeout=DRAIN_TIMEOUT):
+        # Raise if the latest value could not be written, so the session fails
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(self._task), timeout)
+        except asyncio.TimeoutError:
+            self._task.cancel()
+            # Log the value, so it can be recovered by hand
+            LOGGER.error(
+                f"Gave up writing to the {self.kind} store",
+                username=self.username,
+                value=self._value,
+            )
+            raise RuntimeError(
+                f"Failed to write to the {self.kind} store for {self.username!r}"
+            ) from self._error
+
+
+async def read_result(store, username):
+    return normalize_result(await store.get(RESULTS, username))
+
+
+async def read_session(store, username):
+    value = await store.get(SESSIONS, username)
+    return value if isinstance(value, dict) else {}
+
+
+def open_store(spec=None, authorized_keys_dir=None, result_dir=None, secret=None):
+    if spec is None or spec == "files":
+        kwargs = {}
+        if authorized_keys_dir is not None:
+            kwargs["authorized_keys_dir"] = authorized_keys_dir
+        if result_dir is not None:
+            kwargs["result_dir"] = result_dir
+        return FileStore(**kwargs)
+    scheme, _, address = spec.partition(":")
+    if scheme == "sqlite" and address:
+        return SQLiteStore(address)
+    if scheme == "tcp" and address:
+        host, _, port = address.rpartition(":")
+        return CoordinatorStore(host or "localhost", int(port), secret)
+    raise ValueError(f"Invalid store: {spec!r}")
+
+
+# Coordinator process
+
+
+def check_secret(secret, line):
+    try:
+        received = json.loads(line).get("secret")
+    except (ValueError, AttributeError):
+        return False
+    if secret is None:
+        return True
+    return isinstance(received, str) and hmac.compare_digest(
+        received.encode(), secret.encode()
+    )
+
+
+async def handle_coordinator_client(store, reader, writer, secret=None):
+    peername = writer.get_extra_info("peername")
+    methods = {
+        "get": store.get,
+        "set": store.set,
+        "append": store.append,
+        "scan": store.scan,
+    }
+    try:
+        authenticated = check_secret(secret, await reader.readline())
+        writer.write(json.dumps({"authenticated": authenticated}).encode() + b"\n")
+        await writer.drain()
+        if not authenticated:
+            LOGGER.warning("Coordinator client rejected", peer=peername)
+            return
+        LOGGER.info("Coordinator client connected", peer=peername)
+        async for line in reader:
+            request = json.loads(line)
+            response = {"id": request["id"]}
+            try:
+                kind, username, *args = request["args"]
+                if kind not in KINDS:
+                    raise ValueError(f"Invalid kind: {kind!r}")
+                # Scans start with no username
+                if username is not None or request["method"] != "scan":
+                    check_username(username)
+                method = methods[request["method"]]
+                response["result"] = await method(kind, username, *args)
+            except Exception as exc:
+                response["error"] = repr(exc)
+            writer.write(json.dumps(response).encode() + b"\n")
+            await writer.drain()
+    except (ConnectionError, ValueError):
+        pass
+    finally:
+        LOGGER.info("Coordinator client disconnected", peer=peername)
+        writer.close()
+
+
+async def run_coordinator(store, bind="localhost", port=COORDINATOR_PORT, secret=None):
+    async def client_connected(reader, writer):
+        await handle_coordinator_client(store, reader, writer, secret)
+
+    server = await asyncio.start_server(client_connected, bind, port)
+    bind, port = server.sockets[0].getsockname()[:2]
+    print(f"Running a store coordinator on {bind}:{port}...")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await store.close()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog="mcqterm coordinator")
+    parser.add_argument("--port", "-p", type=int, default=COORDINATOR_PORT)
+    parser.add_argument("--bind", "-b", type=str, default="localhost")
+    parser.add_argument("--secret-file", type=Path, default=None)
+    parser.add_argument("--store", type=str, default="files")
+    parser.add_argument(
+        "--authorized-keys-dir", "-a", type=Path, default=Path("authorized_keys")
+    )
+    parser.add_argument("--result-dir", "-r", type=Path, default=Path("results"))
+    namespace = parser.parse_args(args)
+    assert not namespace.store.startswith("tcp:")
+    # Clients can write authorized keys, so they have to be trusted
+    if namespace.bind not in LOCAL_ADDRESSES and namespace.secret_file is None:
+        parser.error("a --secret-file is required to bind a non-local address")
+    secret = read_secret(namespace.secret_file)
+    store = open_store(
+        namespace.store, namespace.authorized_keys_dir, namespace.result_dir
+    )
+    return asyncio.run(run_coordinator(store, namespace.bind, namespace.port, secret))
+
+
+if __name__ == "__main__":
+    main()
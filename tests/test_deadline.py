@@ -0,0 +1,111 @@
+import time
+import asyncio
+import argparse
+
+import pytest
+
+from mcqterm.server import read_time_limits
+from mcqterm.deadline import (
+    Countdown,
+    DeadlineScheduler,
+    format_remaining,
+    get_deadline,
+)
+
+
+def test_format_remaining():
+    assert format_remaining(3600) == "60 min left"
+    assert format_remaining(599.5) == "10 min left"
+    assert format_remaining(61) == "01:01 left"
+    assert format_remaining(-5) == "00:00 left"
+
+
+def test_get_deadline():
+    result_dict = {"started": 1000.0}
+    assert get_deadline(result_dict) is None
+    assert get_deadline(result_dict, time_limit=60) == 1060.0
+    assert get_deadline(result_dict, time_limit=60, exam_deadline=1030.0) == 1030.0
+    result_dict = {}
+    assert get_deadline(result_dict, time_limit=60) == result_dict["started"] + 60
+
+
+def test_expiry_order():
+    async def main():
+        scheduler = DeadlineScheduler(asyncio.get_running_loop())
+        expired = []
+        now = time.time()
+        for name, delay in [("c", 0.15), ("a", 0.05), ("b", 0.1)]:
+            scheduler.register(now + delay, lambda name=name: expired.append(name))
+        await asyncio.sleep(0.3)
+        assert expired == ["a", "b", "c"]
+
+    asyncio.run(main())
+
+
+def test_cancel():
+    async def main():
+        scheduler = DeadlineScheduler(asyncio.get_running_loop())
+        expired = []
+        now = time.time()
+        first = scheduler.register(now + 0.05, lambda: expired.append("a"))
+        scheduler.register(now + 0.1, lambda: expired.append("b"))
+        first.cancel()
+        first.cancel()
+        await asyncio.sleep(0.2)
+        assert expired == ["b"]
+        assert not first.expired
+
+    asyncio.run(main())
+
+
+def test_raising_callback():
+    async def main():
+        scheduler = DeadlineScheduler(asyncio.get_running_loop())
+        expired = []
+
+        def fail():
+            raise RuntimeError("Boom")
+
+        now = time.time()
+        scheduler.register(now + 0.05, fail, on_change=fail)
+        scheduler.register(now + 0.05, lambda: expired.append("a"))
+        scheduler.register(now + 0.15, lambda: expired.append("b"))
+        await asyncio.sleep(0.3)
+        assert expired == ["a", "b"]
+
+    asyncio.run(main())
+
+
+def test_past_deadline():
+    async def main():
+        countdown = Countdown(time.time() - 10)
+        expired = []
+        countdown.start(lambda: expired.append("a"))
+        assert not expired
+        await asyncio.sleep(0.05)
+        assert expired == ["a"]
+        assert countdown.expired
+        assert countdown.text == "00:00 left"
+        # A new application gets notified right away
+        countdown.start(lambda: expired.append("b"))
+        assert expired == ["a", "b"]
+        countdown.stop()
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize(
+    "content", ['{"mark": "60"}', '{"mark": true}', '{"mark": -5}', "[60]", "nope"]
+)
+def test_invalid_time_limits(content, tmp_path):
+    path = tmp_path / "time-limits.json"
+    path.write_text(content)
+    with pytest.raises(SystemExit):
+        read_time_limits(argparse.ArgumentParser(), path)
+
+
+def test_time_limits(tmp_path):
+    path = tmp_path / "time-limits.json"
+    path.write_text('{"mark": 60, "anna": 52.5}')
+    parser = argparse.ArgumentParser()
+    assert read_time_limits(parser, path) == {"mark": 60, "anna": 52.5}
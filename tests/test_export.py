@@ -0,0 +1,67 @@
+import csv
+import json
+from pathlib import Path
+
+import pytest
+
+from mcqterm.export import main
+
+MCQ_FILENAME = Path(__file__).parent.parent / "example" / "mcq-example.md"
+
+
+def write_results(result_dir, results):
+    result_dir.mkdir()
+    for username, content in results.items():
+        if not isinstance(content, str):
+            content = json.dumps(content)
+        (result_dir / f"{username}.json").write_text(content)
+
+
+def read_rows(path):
+    with open(path, newline="") as f:
+        return list(csv.reader(f))
+
+
+def test_export_normalizes_answers(tmp_path):
+    write_results(
+        tmp_path / "results",
+        {
+            "mark": {
+                "name": "Mark",
+                "answers": {"1": "ca", "2": "dB", "3": "xyz"},
+                "comment": "Nice",
+                "started": 1000,
+            },
+            "anna": {"name": "Anna", "answers": {"3": "ccc"}},
+        },
+    )
+    output = tmp_path / "results.csv"
+    main(["-r", str(tmp_path / "results"), "-o", str(output), str(MCQ_FILENAME)])
+    assert read_rows(output) == [
+        ["username", "name", "q1", "q2", "q3", "comment", "started"],
+        ["anna", "Anna", "", "", "C", "", ""],
+        ["mark", "Mark", "AC", "BD", "", "Nice", "1000.0"],
+    ]
+
+
+def test_export_skips_invalid_results(tmp_path, capsys):
+    write_results(
+        tmp_path / "results",
+        {
+            "anna": {"name": "Anna", "answers": {}},
+            "bob": "garbage",
+            "carl": [1, 2],
+        },
+    )
+    output = tmp_path / "results.csv"
+    main(["-r", str(tmp_path / "results"), "-o", str(output), str(MCQ_FILENAME)])
+    assert [row[0] for row in read_rows(output)] == ["username", "anna"]
+    stderr = capsys.readouterr().err
+    assert "'bob'" in stderr
+    assert "'carl'" in stderr
+
+
+def test_export_missing_result_dir(tmp_path, capsys):
+    with pytest.raises(SystemExit):
+        main(["-r", str(tmp_path / "missing"), str(MCQ_FILENAME)])
+    assert "not found" in capsys.readouterr().err
@@ -0,0 +1,175 @@
+import io
+import csv
+import asyncio
+from pathlib import Path
+
+import pytest
+
+from mcqterm.export import export_results
+from mcqterm.store import (
+    AUTHORIZED_KEYS,
+    RESULTS,
+    FileStore,
+    StoreWriter,
+    SQLiteStore,
+    CoordinatorStore,
+    handle_coordinator_client,
+)
+
+MCQ_FILENAME = Path(__file__).parent.parent / "example" / "mcq-example.md"
+
+
+def make_store(kind, tmp_path):
+    if kind == "files":
+        return FileStore(tmp_path / "authorized_keys", tmp_path / "results")
+    return SQLiteStore(str(tmp_path / "mcq.sqlite"))
+
+
+class FlakyStore(FileStore):
+    def __init__(self, *args, failures=1):
+        super().__init__(*args)
+        self.failures = failures
+
+    async def set(self, kind, username, value):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("Lost the coordinator")
+        await super().set(kind, username, value)
+
+
+async def start_coordinator(store, secret=None):
+    async def client_connected(reader, writer):
+        await handle_coordinator_client(store, reader, writer, secret)
+
+    server = await asyncio.start_server(client_connected, "localhost", 0)
+    return server, server.sockets[0].getsockname()[1]
+
+
+@pytest.mark.parametrize("kind", ["files", "sqlite"])
+def test_store(kind, tmp_path):
+    async def main():
+        store = make_store(kind, tmp_path)
+        assert await store.get(RESULTS, "mark") is None
+        await store.set(RESULTS, "mark", {"name": "Mark"})
+        assert await store.get(RESULTS, "mark") == {"name": "Mark"}
+        await store.append(AUTHORIZED_KEYS, "mark", "key 1\n")
+        await store.append(AUTHORIZED_KEYS, "mark", "key 2\n")
+        assert await store.get(AUTHORIZED_KEYS, "mark") == "key 1\nkey 2\n"
+        await store.close()
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize("kind", ["files", "sqlite"])
+def test_store_scan(kind, tmp_path):
+    async def main():
+        store = make_store(kind, tmp_path)
+        usernames = [f"user{i:03d}" for i in range(600)]
+        for username in reversed(usernames):
+            await store.set(RESULTS, username, {"name": username})
+        items = [item async for item in store.iter_items(RESULTS)]
+        assert items == [(username, {"name": username}) for username in usernames]
+        await store.close()
+
+    asyncio.run(main())
+
+
+def test_file_store_rejects_invalid_usernames(tmp_path):
+    async def main():
+        store = make_store("files", tmp_path / "store")
+        for username in ["", ".", "..", "../escaped", "a/b", ".sessions"]:
+            with pytest.raises(ValueError):
+                await store.append(AUTHORIZED_KEYS, username, "key\n")
+
+    asyncio.run(main())
+    assert not (tmp_path / "escaped").exists()
+
+
+def test_coordinator(tmp_path):
+    async def main():
+        server, port = await start_coordinator(make_store("files", tmp_path))
+        async with server:
+            # Two clients, as two servers of the same cluster
+            client1 = CoordinatorStore("localhost", port)
+            client2 = CoordinatorStore("localhost", port)
+            await client1.set(RESULTS, "mark", {"name": "Mark"})
+            assert await client2.get(RESULTS, "mark") == {"name": "Mark"}
+            await asyncio.gather(
+                client1.append(AUTHORIZED_KEYS, "mark", "key 1\n"),
+                client2.append(AUTHORIZED_KEYS, "mark", "key 2\n"),
+            )
+            keys = await client1.get(AUTHORIZED_KEYS, "mark")
+            assert sorted(keys.splitlines()) == ["key 1", "key 2"]
+            assert await client2.scan(RESULTS) == [["mark", {"name": "Mark"}]]
+            with pytest.raises(RuntimeError):
+                await client1.append(AUTHORIZED_KEYS, "../escaped", "key\n")
+            await client1.close()
+            await client2.close()
+
+    asyncio.run(main())
+    assert not (tmp_path / "escaped").exists()
+
+
+def test_coordinator_secret(tmp_path):
+    async def main():
+        store = make_store("files", tmp_path)
+        server, port = await start_coordinator(store, secret="secret")
+        async with server:
+            for secret in [None, "wrong"]:
+                client = CoordinatorStore("localhost", port, secret)
+                with pytest.raises(ConnectionError):
+                    await client.append(AUTHORIZED_KEYS, "mark", "key\n")
+                await client.close()
+            client = CoordinatorStore("localhost", port, "secret")
+            await client.append(AUTHORIZED_KEYS, "mark", "key\n")
+            await client.close()
+        assert await store.get(AUTHORIZED_KEYS, "mark") == "key\n"
+
+    asyncio.run(main())
+
+
+def test_export_from_store(tmp_path, monkeypatch):
+    async def fill():
+        store = make_store("sqlite", tmp_path)
+        await store.set(RESULTS, "mark", {"name": "Mark", "answers": {"1": "a"}})
+        await store.set(RESULTS, "anna", {"name": "Anna", "answers": {}})
+        await store.close()
+
+    asyncio.run(fill())
+    output = io.StringIO()
+    monkeypatch.setattr("sys.stdout", output)
+    export_results(MCQ_FILENAME, None, store=make_store("sqlite", tmp_path))
+    rows = list(csv.reader(io.StringIO(output.getvalue())))
+    assert rows[0][:3] == ["username", "name", "q1"]
+    assert [row[:3] for row in rows[1:]] == [
+        ["anna", "Anna", ""],
+        ["mark", "Mark", "A"],
+    ]
+
+
+def test_store_writer_retries(tmp_path):
+    async def main():
+        store = FlakyStore(tmp_path / "keys", tmp_path / "results", failures=3)
+        writer = StoreWriter(store, RESULTS, "mark")
+        writer({"name": "Mark", "answers": {"1": "A"}})
+        writer({"name": "Mark", "answers": {"1": "B"}})
+        await writer.drain()
+        assert await store.get(RESULTS, "mark") == {
+            "name": "Mark",
+            "answers": {"1": "B"},
+        }
+
+    asyncio.run(main())
+
+
+def test_store_writer_drain_raises(tmp_path):
+    async def main():
+        store = FlakyStore(tmp_path / "keys", tmp_path / "results", failures=100)
+        writer = StoreWriter(store, RESULTS, "mark")
+        writer({"name": "Mark"})
+        with pytest.raises(RuntimeError) as info:
+            await writer.drain(timeout=0.5)
+        assert isinstance(info.value.__cause__, ConnectionError)
+        assert await store.get(RESULTS, "mark") is None
+
+    asyncio.run(main())